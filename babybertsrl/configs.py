@@ -19,6 +19,8 @@ class Training:
     feedback_interval = 100
     ignored_index = -1 # any ids in argument "tags" to cross-entropy fn are ignored
     debug = False
+    mixed_precision = False  # float16 autocast + gradient scaling, requires torch>=1.6 and Tensor Cores (Volta+)
+    compile_bert = False  # fuse kernels with torch.compile, requires torch>=2.0. adds '_orig_mod.' to BERT state_dict keys
 
 
 class Eval:
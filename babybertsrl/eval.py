@@ -1,11 +1,25 @@
 import time
 import torch
-from typing import Iterator, Optional
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
 from pathlib import Path
 
 from babybertsrl.scorer import SrlEvalScorer, convert_bio_tags_to_conll_format
 from babybertsrl.model_mt import MTBert
 
+# inference_mode() has less overhead than no_grad(), but is not available before torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+@lru_cache(maxsize=2 ** 16)
+def bio2conll(tags: Tuple[str, ...],
+              ) -> List[str]:
+    """
+    cached, because the same tag sequences (especially gold tag sequences) are converted at every evaluation.
+    the returned list is shared between calls and must not be modified.
+    """
+    return convert_bio_tags_to_conll_format(list(tags))
+
 
 def predict_masked_sentences(model: MTBert,
                              instances_generator: Iterator,
@@ -21,7 +35,7 @@ def predict_masked_sentences(model: MTBert,
     for batch in instances_generator:
 
         # get predictions
-        with torch.no_grad():
+        with inference_mode():
             output_dict = model(task='mlm', **batch)  # input is dict[str, tensor]
             predicted_mlm_tags += model.decode_mlm(output_dict)
 
@@ -53,19 +67,17 @@ def evaluate_model_on_pp(model: MTBert,
                          ) -> float:
     model.eval()
 
-    pp_sum = torch.zeros(size=(1,)).cuda()
+    pp_sum = 0.0  # becomes a tensor on GPU, so that no step waits for the GPU to copy a scalar to CPU
     num_steps = 0
     for step, batch in enumerate(instances_generator):
 
         # get predictions
-        with torch.no_grad():
+        with inference_mode():
             output_dict = model(task='mlm', **batch)  # input is dict[str, tensor]
-
-        pp = torch.exp(output_dict['loss'])
-        pp_sum += pp
+            pp_sum += torch.exp(output_dict['loss'].float())
         num_steps += 1
 
-    return pp_sum.cpu().numpy().item() / num_steps
+    return float(pp_sum) / num_steps  # single copy from GPU to CPU
 
 
 def evaluate_model_on_f1(model: MTBert,
@@ -82,20 +94,19 @@ def evaluate_model_on_f1(model: MTBert,
     for step, batch in enumerate(instances_generator):
 
         # get predictions
-        with torch.no_grad():
+        with inference_mode():
             output_dict = model(task='srl', **batch)  # input is dict[str, tensor]
+            batch_bio_predicted_tags = model.decode_srl(output_dict)  # get the BIO tags from decode()
 
         # metadata
         metadata = batch['metadata']
         batch_verb_indices = [example_metadata['verb_index'] for example_metadata in metadata]
         batch_sentences = [example_metadata['in'] for example_metadata in metadata]
 
-        # Get the BIO tags from decode()
-        batch_bio_predicted_tags = model.decode_srl(output_dict)
-        batch_conll_predicted_tags = [convert_bio_tags_to_conll_format(tags) for
+        batch_conll_predicted_tags = [bio2conll(tuple(tags)) for
                                       tags in batch_bio_predicted_tags]
         batch_bio_gold_tags = [example_metadata['gold_tags'] for example_metadata in metadata]
-        batch_conll_gold_tags = [convert_bio_tags_to_conll_format(tags) for
+        batch_conll_gold_tags = [bio2conll(tuple(tags)) for
                                  tags in batch_bio_gold_tags]
 
         # update signal detection metrics
@@ -1,5 +1,5 @@
 import numpy as np
-from typing import List
+from typing import Generator, List
 from pathlib import Path
 import random
 from collections import OrderedDict
@@ -92,25 +92,23 @@ def split(data: List, seed: int = 2):
     return train, devel, test
 
 
-def load_utterances_from_file(file_path: Path,
-                              verbose: bool = False) -> List[List[str]]:
+def gen_utterances_from_file(file_path: Path,
+                             ) -> Generator[List[str], None, None]:
     """
-    load utterances for language modeling from text file
+    lazily load utterances for language modeling from text file, one line at a time
     """
 
     print(f'Loading {file_path}')
 
-    res = []
     punctuation = {'.', '?', '!'}
     num_too_small = 0
     num_too_large = 0
     with file_path.open('r') as f:
 
-        for line in f.readlines():
+        for line in f:
 
             # tokenize transcript
             transcript = line.strip().split()  # a transcript containing multiple utterances
-            transcript = [w for w in transcript]
 
             # split transcript into utterances
             utterances = [[]]
@@ -130,11 +128,20 @@ def load_utterances_from_file(file_path: Path,
                     num_too_large += 1
                     continue
 
-                res.append(utterance)
+                yield utterance
 
     print(f'WARNING: Skipped {num_too_small} utterances which are shorter than {configs.Data.min_input_length}.')
     print(f'WARNING: Skipped {num_too_large} utterances which are larger than {configs.Data.max_input_length}.')
 
+
+def load_utterances_from_file(file_path: Path,
+                              verbose: bool = False) -> List[List[str]]:
+    """
+    load utterances for language modeling from text file
+    """
+
+    res = list(gen_utterances_from_file(file_path))
+
     if verbose:
         lengths = [len(u) for u in res]
         print('Found {:,} utterances'.format(len(res)))
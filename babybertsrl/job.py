@@ -146,6 +146,10 @@ def main(param2val):
                              num_attention_heads=params.num_attention_heads,  # was 12
                              intermediate_size=params.intermediate_size)  # was 3072
     bert_model = BertModel(config=bert_config)
+    if configs.Training.compile_bert and hasattr(torch, 'compile'):
+        # only BERT is compiled - decoding in MTBert is python code that would break the graph anyway.
+        # sequence lengths vary between batches, so shapes are compiled as dynamic to avoid re-compiling
+        bert_model = torch.compile(bert_model, dynamic=True)
     # Multi-tasking BERT
     mt_bert = MTBert(id2tag_wp_mlm={i: t for t, i in wordpiece_tokenizer.vocab.items()},
                      id2tag_wp_srl=effective_vocab_srl.get_index_to_token_vocabulary('labels'),
@@ -1,15 +1,14 @@
 from typing import Dict, List, Any
+import contextlib
 import torch
 import numpy as np
-from torch.nn import Linear, Dropout, functional as F
+from torch.nn import Linear, Dropout
 from torch.nn import CrossEntropyLoss
+from torch.nn.utils import clip_grad_norm_
 from pytorch_pretrained_bert.modeling import BertModel, BertOnlyMLMHead
 
-from allennlp.nn.util import get_text_field_mask
 from allennlp.nn.util import sequence_cross_entropy_with_logits
 from allennlp.nn.util import get_lengths_from_binary_sequence_mask
-from allennlp.nn.util import viterbi_decode
-from allennlp.training.util import rescale_gradients
 
 from babybertsrl.word_pieces import convert_wordpieces_to_words
 from babybertsrl import configs
@@ -34,6 +33,9 @@ class MTBert(torch.nn.Module):
         # vocab for heads
         self.id2tag_wp_srl = id2tag_wp_srl
         self.id2tag_wp_mlm = id2tag_wp_mlm
+        # tuples indexed by tag id are faster to look up during decoding than dicts
+        self.tags_wp_srl = tuple(self.id2tag_wp_srl[i] for i in range(len(self.id2tag_wp_srl)))
+        self.tags_wp_mlm = tuple(self.id2tag_wp_mlm[i] for i in range(len(self.id2tag_wp_mlm)))
         # Allen NLP vocab gives same word indices as word-piece tokenizer
         # because indices are obtained from word-piece tokenizer during conversion to instances
 
@@ -45,6 +47,27 @@ class MTBert(torch.nn.Module):
 
         self.xe = CrossEntropyLoss(ignore_index=configs.Training.ignored_index)  # ignore tags with index=ignore_index
 
+        # mixed precision - torch.cuda.amp.autocast is not available before torch 1.6,
+        # and float16 is slower than float32 on GPUs without Tensor Cores (compute capability < 7)
+        self.use_amp = configs.Training.mixed_precision \
+            and hasattr(torch.cuda, 'amp') \
+            and hasattr(torch.cuda.amp, 'autocast') \
+            and torch.cuda.is_available() \
+            and torch.cuda.get_device_capability()[0] >= 7
+        if configs.Training.mixed_precision and not self.use_amp:
+            print('WARNING: Mixed precision requires torch>=1.6 and a GPU with Tensor Cores. Using float32')
+        self.grad_scaler = torch.cuda.amp.GradScaler() if self.use_amp else None
+
+    def autocast(self):
+        """
+        context in which BERT and heads run in float16 where this is safe.
+        losses are computed in float32, because autocast does so for log_softmax and cross-entropy.
+        """
+        if self.use_amp:
+            return torch.cuda.amp.autocast()
+        else:
+            return contextlib.suppress()  # does nothing
+
     def forward(self,
                 task: str,
                 tokens: Dict[str, torch.Tensor],
@@ -83,33 +106,34 @@ class MTBert(torch.nn.Module):
 
         loss = None
 
-        # move to GPU
-        tokens['tokens'] = tokens['tokens'].cuda()
-        indicator = indicator.cuda()
+        # move to GPU - all copies are issued before any computation, so that they can overlap with it
+        tokens['tokens'] = tokens['tokens'].cuda(non_blocking=True)
+        indicator = indicator.cuda(non_blocking=True)
         if tags is not None:
-            tags = tags.cuda()
+            tags = tags.cuda(non_blocking=True)
 
         # get BERT contextualized embeddings
-        mask = get_text_field_mask(tokens)
-        bert_embeddings, _ = self.bert_model(input_ids=tokens['tokens'],
-                                             token_type_ids=indicator,
-                                             attention_mask=mask,
-                                             output_all_encoded_layers=False)
-        embedded_text_input = self.embedding_dropout(bert_embeddings)
-        batch_size, sequence_length, _ = embedded_text_input.size()
-
-        # use correct head for task
-        if task == 'mlm':
-            logits = self.head_mlm(bert_embeddings)  # projects to vector of size bert_config.vocab_size
-            if tags is not None:
-                loss = self.xe(logits.view(-1, self.bert_model.config.vocab_size), tags.view(-1))
-
-        elif task == 'srl':
-            logits = self.head_srl(embedded_text_input)
-            if tags is not None:
-                loss = sequence_cross_entropy_with_logits(logits, tags, mask)
-        else:
-            raise AttributeError('Invalid arg to "task"')
+        mask = tokens['tokens'].ne(0).long()  # [PAD] has index 0 in word-piece vocab
+        with self.autocast():
+            bert_embeddings, _ = self.bert_model(input_ids=tokens['tokens'],
+                                                 token_type_ids=indicator,
+                                                 attention_mask=mask,
+                                                 output_all_encoded_layers=False)
+            embedded_text_input = self.embedding_dropout(bert_embeddings)
+            batch_size, sequence_length, _ = embedded_text_input.size()
+
+            # use correct head for task
+            if task == 'mlm':
+                logits = self.head_mlm(bert_embeddings)  # projects to vector of size bert_config.vocab_size
+                if tags is not None:
+                    loss = self.xe(logits.view(-1, self.bert_model.config.vocab_size), tags.view(-1))
+
+            elif task == 'srl':
+                logits = self.head_srl(embedded_text_input)
+                if tags is not None:
+                    loss = sequence_cross_entropy_with_logits(logits, tags, mask)
+            else:
+                raise AttributeError('Invalid arg to "task"')
 
         output_dict = {"logits": logits,
                        "mask": mask,         # for decoding
@@ -158,7 +182,7 @@ class MTBert(torch.nn.Module):
             assert len(wp_id) == 1
             logits_for_masked_wp = logits[seq_id][wp_id]  # shape is now [vocab_size]
             tag_wp_id = np.asscalar(np.argmax(logits_for_masked_wp))
-            tag_wp = self.id2tag_wp_mlm[tag_wp_id]
+            tag_wp = self.tags_wp_mlm[tag_wp_id]
 
             # fill in input sequence
             mlm_in = output_dict['in'][seq_id]
@@ -177,30 +201,22 @@ class MTBert(torch.nn.Module):
         2) convert back from wordpieces
 
 
-        Do NOT use decoding constraints - transition matrix has zeros only
+        Do NOT use decoding constraints - tags are decoded independently at each time step,
         we are interested in learning dynamics, not best performance.
         Note: decoding is performed on word-pieces, and word-pieces are then converted to whole words
         """
 
-        # get probabilities
-        logits = output_dict['logits']
-        reshaped_logits = logits.view(-1, len(self.id2tag_wp_srl))  # collapse time steps and batches
-        class_probabilities = F.softmax(reshaped_logits, dim=-1).view([logits.shape[0],
-                                                                       logits.shape[1],
-                                                                       len(self.id2tag_wp_srl)])
+        # get max likelihood tags - no softmax needed, because it does not change which tag scores highest
+        # note: without transition constraints, viterbi decoding reduces to argmax at each time step.
+        # argmax is taken on GPU, so that only tag ids, not scores for all tags, are copied to CPU
+        ml_tag_wp_ids = output_dict['logits'].detach().argmax(dim=-1).cpu().tolist()  # ml = max likelihood
         sequence_lengths = get_lengths_from_binary_sequence_mask(output_dict['mask']).data.tolist()
 
-        # ph: transition matrices contain only ones (and no -inf, which would signal illegal transition)
-        transition_matrix = torch.zeros([len(self.id2tag_wp_srl), len(self.id2tag_wp_srl)])
-
         # loop over each sequence in batch
         res = []
-        for seq_id in range(logits.shape[0]):
-            # get max likelihood tags
-            length = sequence_lengths[seq_id]
-            tag_wp_probabilities = class_probabilities[seq_id].detach().cpu()[:length]
-            ml_tag_wp_ids, _ = viterbi_decode(tag_wp_probabilities, transition_matrix)  # ml = max likelihood
-            ml_tags_wp = [self.id2tag_wp_srl[tag_id] for tag_id in ml_tag_wp_ids]
+        tags_wp_srl = self.tags_wp_srl
+        for seq_id, length in enumerate(sequence_lengths):
+            ml_tags_wp = [tags_wp_srl[tag_id] for tag_id in ml_tag_wp_ids[seq_id][:length]]
 
             # convert back from wordpieces
             ml_tags = [ml_tags_wp[i] for i in output_dict['start_offsets'][seq_id]]  # specific to BIO SRL tags
@@ -217,8 +233,15 @@ class MTBert(torch.nn.Module):
             raise ValueError("nan loss encountered")
 
         # backward + update
-        loss.backward()
-        rescale_gradients(self, grad_norm=1.0)
-        optimizer.step()
+        if self.grad_scaler is not None:
+            self.grad_scaler.scale(loss).backward()
+            self.grad_scaler.unscale_(optimizer)  # gradients must be unscaled before they are clipped
+            clip_grad_norm_(self.parameters(), max_norm=1.0)
+            self.grad_scaler.step(optimizer)
+            self.grad_scaler.update()
+        else:
+            loss.backward()
+            clip_grad_norm_(self.parameters(), max_norm=1.0)
+            optimizer.step()
 
         return loss
\ No newline at end of file
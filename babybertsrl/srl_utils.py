@@ -5,21 +5,25 @@ def make_srl_string(words: List[str],
                     tags: List[str]) -> str:
     frame = []
     chunk = []
+    frame_append = frame.append
+    chunk_append = chunk.append
 
     for (token, tag) in zip(words, tags):
-        if tag.startswith("I-"):
-            chunk.append(token)
-        else:
-            if chunk:
-                frame.append("[" + " ".join(chunk) + "]")
-                chunk = []
+        c = tag[:1]  # single character compare is cheaper than startswith(), and is safe for empty tags
+        if c == "I":
+            chunk_append(token)
+            continue
 
-            if tag.startswith("B-"):
-                chunk.append(tag[2:] + ": " + token)
-            elif tag == "O":
-                frame.append(token)
+        if chunk:
+            frame_append("[" + " ".join(chunk) + "]")
+            chunk.clear()
+
+        if c == "B":
+            chunk_append(tag[2:] + ": " + token)
+        elif tag == "O":
+            frame_append(token)
 
     if chunk:
-        frame.append("[" + " ".join(chunk) + "]")
+        frame_append("[" + " ".join(chunk) + "]")
 
     return " ".join(frame)
\ No newline at end of file
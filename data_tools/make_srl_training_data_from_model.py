@@ -1,15 +1,22 @@
 from spacy.tokens import Doc
-import pyprind
+from spacy.attrs import POS
+from spacy.symbols import VERB
+import numpy as np
 from deepsegment import DeepSegment
-from typing import Generator
+from typing import Any, Dict, Generator, Iterator, List
 import logging
+import json
+import queue
+import threading
 import tensorflow as tf
+import torch
 
 from allennlp.predictors.predictor import Predictor
 from allennlp.data.instance import Instance
-from allennlp.common.util import sanitize
+from allennlp.data.dataset import Batch
+from allennlp.nn.util import move_to_device
 
-from babybertsrl.io import load_utterances_from_file
+from babybertsrl.io import gen_utterances_from_file
 from babybertsrl import configs
 from babybertsrl.job import Params
 from babybertsrl.params import param2default
@@ -18,39 +25,126 @@ from babybertsrl.srl_utils import make_srl_string
 CORPUS_NAME = 'childes-20191206'
 INTERACTIVE = False
 BATCH_SIZE = 128
+FEEDBACK_INTERVAL = 100  # number of batches between progress messages
+POOL_SIZE = 16 * BATCH_SIZE  # number of instances sorted by length at once
+SEGMENT_WINDOW = 256  # number of segments POS-tagged at once
+SPACY_BATCH_SIZE = 64
 
+join = " ".join
 
-def gen_instances_from_segment(seg: str,
-                               ) -> Generator[Instance, None, None]:
-    # POS-tagging
-    words = seg.split()
-    spacy_doc = Doc(predictor._tokenizer.spacy.vocab, words=words)
-    for pipe in filter(None, predictor._tokenizer.spacy.pipeline):
-        pipe[1](spacy_doc)  # this does POS tagging
 
+def gen_instances_from_doc(spacy_doc: Doc,
+                           ) -> Generator[Instance, None, None]:
     # to instances - one for each verb in utterance
     tokens = [token for token in spacy_doc]
-    for i, word in enumerate(tokens):
-        if word.pos_ == "VERB":
-            verb_labels = [0 for _ in words]
-            verb_labels[i] = 1
-            instance = predictor._dataset_reader.text_to_instance(tokens, verb_labels)
-
-            yield instance
+    verb_positions = np.flatnonzero(spacy_doc.to_array([POS]) == VERB)
+    for i in verb_positions:
+        verb_labels = [0 for _ in tokens]
+        verb_labels[int(i)] = 1
+        instance = predictor._dataset_reader.text_to_instance(tokens, verb_labels)
+
+        yield instance
+
+
+def pos_tag_segments(segments: List[str],
+                     ) -> Iterator[Doc]:
+    """
+    POS-tag a window of segments with each pipeline component's batched pipe().
+    Docs are made from whitespace-split words, so that spaCy does not re-tokenize segments.
+    """
+    nlp = predictor._tokenizer.spacy
+    docs = (Doc(nlp.vocab, words=seg.split()) for seg in segments)
+    for name, proc in nlp.pipeline:
+        if hasattr(proc, 'pipe'):
+            docs = proc.pipe(docs, batch_size=SPACY_BATCH_SIZE)
+        else:
+            docs = map(proc, docs)
+    return docs
 
 
 def gen_instances() -> Generator[Instance, None, None]:
+    segments = []
     for u in utterances:
         # possibly segment utterance into multiple well-formed sentences
+        # segmentation is deterministic, so segments are cached across runs
         words_string = ' '.join(u)
-        segments = segmentation.segment(words_string)
-        for segment in segments:
-            instances = gen_instances_from_segment(segment)
-            # in case no verbs are found
-            if not instances:
-                continue
-            else:
-                yield from instances
+        if words_string not in seg_cache:
+            seg_cache[words_string] = segmentation.segment(words_string)
+        segments += seg_cache[words_string]
+
+        # POS-tag many segments at once
+        if len(segments) >= SEGMENT_WINDOW:
+            for spacy_doc in pos_tag_segments(segments):
+                yield from gen_instances_from_doc(spacy_doc)
+            segments = []
+
+    for spacy_doc in pos_tag_segments(segments):
+        yield from gen_instances_from_doc(spacy_doc)
+
+
+def gen_length_sorted_instances() -> Generator[Instance, None, None]:
+    """
+    sort pools of instances by number of tokens,
+    so that instances in the same batch have similar length, and less compute is spent on padding
+    """
+    pool = []
+    for instance in gen_instances():
+        pool.append(instance)
+        if len(pool) == POOL_SIZE:
+            pool.sort(key=lambda inst: len(inst.fields['tokens'].tokens))
+            yield from pool
+            pool = []
+    pool.sort(key=lambda inst: len(inst.fields['tokens'].tokens))
+    yield from pool
+
+
+def make_tensor_dict(instances: List[Instance],
+                     ) -> Dict[str, Any]:
+    """
+    index and pad a batch of instances, as forward_on_instances() would do,
+    but without separating outputs into one numpy dict per instance afterwards
+    """
+    batch = Batch(instances)
+    batch.index_instances(predictor._model.vocab)
+    return batch.as_tensor_dict(batch.get_padding_lengths())
+
+
+def produce_batches(q: queue.Queue,
+                    ) -> None:
+    """
+    fill batches with instances and convert them to tensors in a background thread,
+    so that the next batch is ready while the tagger is busy with the current one.
+    None is put on the queue to signal that there are no more batches,
+    and an exception is put on the queue so that it can be re-raised in the main thread.
+    """
+    try:
+        batch = []
+        for instance in gen_length_sorted_instances():
+            batch.append(instance)
+            if len(batch) == BATCH_SIZE:
+                q.put(make_tensor_dict(batch))
+                batch = []
+        if batch:
+            q.put(make_tensor_dict(batch))
+    except BaseException as e:
+        q.put(e)
+    else:
+        q.put(None)
+
+
+def save_seg_cache() -> None:
+    """
+    save a snapshot of the segmentation cache, because the producer thread may still be adding to it.
+    the file is replaced only after it is completely written, so an interrupted save cannot corrupt it.
+    """
+    snapshot = dict(seg_cache)
+    if len(snapshot) == num_cached:
+        return
+    print(f'Saving segmentation cache to {seg_cache_path}')
+    tmp_seg_cache_path = seg_cache_path.with_suffix('.tmp')
+    with tmp_seg_cache_path.open('w') as seg_cache_file:
+        json.dump(snapshot, seg_cache_file)
+    tmp_seg_cache_path.replace(seg_cache_path)
 
 
 # srl tagger
@@ -66,73 +160,96 @@ segmentation = DeepSegment('en')
 # utterances
 utterances_path = configs.Dirs.data / 'training' / f'{CORPUS_NAME}_mlm.txt'
 params = Params.from_param2val(param2default)
-utterances = load_utterances_from_file(utterances_path)
-
-it = gen_instances()
+utterances = gen_utterances_from_file(utterances_path)  # consumed lazily by gen_instances()
+
+# segmentation cache
+# note: the cache holds every utterance string and its segments in memory, so the corpus is not loaded lazily
+seg_cache_path = utterances_path.with_suffix('.segments.json')
+seg_cache = {}
+if seg_cache_path.exists():
+    print(f'Loading segmentation cache from {seg_cache_path}')
+    try:
+        with seg_cache_path.open('r') as seg_cache_file:
+            seg_cache = json.load(seg_cache_file)
+    except (OSError, ValueError) as e:
+        print(f'WARNING: Ignoring unreadable segmentation cache: {e}')
+num_cached = len(seg_cache)
+
+batch_queue = queue.Queue(maxsize=2)  # do not let CPU pre-processing run too far ahead of the tagger
+threading.Thread(target=produce_batches, args=(batch_queue,), daemon=True).start()
+
+# lines are written to a temporary file, which replaces the existing corpus only after a complete run
+srl_path = configs.Dirs.data / 'training' / f'{CORPUS_NAME}_srl.txt'
+tmp_path = srl_path.with_suffix('.tmp')
 
-progress_bar = pyprind.ProgBar(len(utterances) // BATCH_SIZE, stream=1)
+num_batches = 0
 num_no_verb = 0
 num_only_verb = 0
 lines = set()
-outer_loop = True
-while outer_loop:
-
-    # fill batch with instances
-    batch = []
-    while len(batch) < BATCH_SIZE:
-        try:
-            instance = next(it)
-        except StopIteration:
-            outer_loop = False
-            break
-        batch.append(instance)
-
-    # get SRL predictions for batch of instances
-    res = predictor._model.forward_on_instances(batch)
-
-    # make a line for each instance
-    for d in sanitize(res):
-        tags = d['tags']
-        words = d['words']
-
-        # sometimes there is no B-V
-        if 'B-V' not in tags:
-            num_no_verb += 1
-            continue
-
-        # sometimes there is only a verb but no arguments (e.g. auxiliary word) - skip
-        if not [tag for tag in tags if 'ARG' in tag]:
-            num_only_verb += 1
-            continue
-
-        # make line
-        verb_index = tags.index('B-V')
-        x_string = " ".join(words)
-        y_string = " ".join(tags)
-        line = f'{verb_index} {x_string} ||| {y_string}'
+try:
+    with tmp_path.open('w') as srl_file:
+        while True:
+
+            # get batch of tensors prepared in background
+            tensor_dict = batch_queue.get()
+            if tensor_dict is None:
+                break
+            if isinstance(tensor_dict, BaseException):
+                raise tensor_dict  # error in background thread
+
+            # get SRL predictions for batch
+            with torch.no_grad():
+                output_dict = predictor._model(**move_to_device(tensor_dict, cuda_device=0))
+                output_dict = predictor._model.decode(output_dict)
+
+            # make a line for each instance
+            for words, tags in zip(output_dict['words'], output_dict['tags']):
+                # sometimes there is no B-V
+                try:
+                    verb_index = tags.index('B-V')
+                except ValueError:
+                    num_no_verb += 1
+                    continue
+
+                # sometimes there is only a verb but no arguments (e.g. auxiliary word) - skip
+                if not [tag for tag in tags if 'ARG' in tag]:
+                    num_only_verb += 1
+                    continue
+
+                # make line
+                line = f'{verb_index} {join(words)} ||| {join(tags)}'
+
+                if INTERACTIVE:
+                    print('=====================================')
+                    print(make_srl_string(words, tags))
+                    print(line)
+                    key = input('\n[q] to quit. Any key to continue.\n')
+                    if key != 'q':
+                        pass
+                    else:
+                        raise SystemExit('Quit')
+
+                if line in lines:
+                    continue
+                if not INTERACTIVE:  # stream to file - quitting interactive mode should not leave a partial file
+                    if lines:  # do not write '\n' at end of file
+                        srl_file.write('\n')
+                    srl_file.write(line)
+                lines.add(line)
+
+            num_batches += 1
+            if num_batches % FEEDBACK_INTERVAL == 0:  # number of utterances is unknown, so no progress bar
+                print(f'Tagged {num_batches:,} batches. Wrote {len(lines):,} lines', flush=True)
 
         if INTERACTIVE:
-            print('=====================================')
-            print(make_srl_string(words, tags))
-            print(line)
-            key = input('\n[q] to quit. Any key to continue.\n')
-            if key != 'q':
-                pass
-            else:
-                raise SystemExit('Quit')
-
-        lines.add(line)
-
-    progress_bar.update()
-
-print(f'Collected {len(lines)} lines')
+            srl_file.write('\n'.join(lines))
+except BaseException:
+    tmp_path.unlink()
+    raise
+finally:
+    save_seg_cache()  # also when quitting or crashing, so that segmentations are not lost
+tmp_path.replace(srl_path)
+
+print(f'Wrote {len(lines)} lines to {srl_path}')
 print(f'Skipped {num_no_verb} utterances due to absence of B-V tag')
-print(f'Skipped {num_only_verb} utterances due to presence of only B-V tag')
-
-print(f'Writing {len(lines)} lines to file...')
-srl_path = configs.Dirs.data / 'training' / f'{CORPUS_NAME}_srl.txt'
-with srl_path.open('w') as f:
-    for n, line in enumerate(lines):
-        f.write(line)
-        if n + 1 != len(lines):  # do not write '\n' at end of file
-            f.write('\n')
\ No newline at end of file
+print(f'Skipped {num_only_verb} utterances due to presence of only B-V tag')
\ No newline at end of file